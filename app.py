@@ -1,27 +1,104 @@
+# Patch the stdlib for cooperative I/O before anything else imports socket/threading
+from gevent import monkey
+monkey.patch_all()
+import gevent
+
 from datetime import datetime, timedelta
+import hashlib
+import logging
 import os
+import threading
+import time
 from functools import wraps
 from dotenv import load_dotenv
+from cachetools import TTLCache
+import orjson
 
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import (Flask, render_template, request, redirect, url_for, flash, jsonify, session,
+                   make_response)
+from flask.json.provider import DefaultJSONProvider
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_socketio import SocketIO, emit, join_room, leave_room, disconnect
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import event, select, update, func, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import selectinload, raiseload, aliased
 
 # Load environment variables from .env file
 load_dotenv()
 
 from config import Config
-from models import db, User, Message, VoiceRoom, VoiceParticipant, CoinTransaction, DMUnlock, VoiceComment
+from models import (db, User, Message, VoiceRoom, VoiceParticipant, CoinTransaction, DMUnlock, VoiceComment,
+                    add_missing_columns, collapse_duplicate_dm_unlocks, create_missing_indexes)
+
+logger = logging.getLogger(__name__)
 
 MAX_STAGE = 10               # voice-room speakers cap
 DM_FREE_MSG_LIMIT = 3        # free msgs without reply
+HOST_CACHE_TTL = 60          # seconds a room's host list is trusted
+MESSAGES_PAGE_SIZE = 50      # default /api/messages page
+STATUS_FLUSH_INTERVAL = 2    # seconds between batched presence writes
+HEALTHZ_BODY = b'{"status":"healthy"}'
+# Changes on every deploy/restart so page ETags never outlive the code that rendered them
+PAGE_VERSION = str(time.time_ns())
+
+# room_id -> [host user ids]; hosts change rarely, stage requests often
+_host_cache = TTLCache(maxsize=1024, ttl=HOST_CACHE_TTL)
+_host_cache_lock = threading.Lock()
+
+# user_id -> latest "online"/"offline" not yet written; last change wins
+_pending_status: dict[int, str] = {}
+_pending_status_lock = threading.Lock()
+
+PASSWORD_HASH_METHOD = "scrypt:32768:8:1"
+
+def hash_password(password):
+    """Hash on gevent's native thread pool so the KDF doesn't stall every greenlet."""
+    return gevent.get_hub().threadpool.apply(
+        generate_password_hash, (password,), {"method": PASSWORD_HASH_METHOD})
+
+def verify_password(pwhash, password):
+    """Counterpart of hash_password; also verifies older pbkdf2 hashes."""
+    return gevent.get_hub().threadpool.apply(check_password_hash, (pwhash, password))
+
+# Checked against for unknown usernames so their login costs the same as a real one
+_DUMMY_HASH = generate_password_hash("invalid", method=PASSWORD_HASH_METHOD)
+
+class OrjsonSocketIOJSON:
+    """json-module stand-in for python-socketio: orjson returns bytes and rejects separators=."""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider (jsonify, request.get_json) backed by orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 def create_app():
     app = Flask(__name__, instance_relative_config=True,
                 static_folder='static', template_folder='templates')
     app.config.from_object(Config)
+    app.json = OrjsonProvider(app)
     os.makedirs(app.instance_path, exist_ok=True)
+    logging.basicConfig(level=logging.DEBUG if app.debug else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    # Keep compiled templates on disk so fresh workers skip the Jinja compile step
+    jinja_cache_dir = os.path.join(app.instance_path, "jinja_cache")
+    os.makedirs(jinja_cache_dir, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory=jinja_cache_dir)
     
     # Fix database URI to use absolute path (Flask's instance_relative_config can cause issues)
     # This must be done BEFORE db.init_app()
@@ -32,6 +109,19 @@ def create_app():
 
     db.init_app(app)
 
+    # SQLite: WAL lets reads run alongside writes and NORMAL sync drops per-commit fsyncs
+    with app.app_context():
+        if db.engine.url.drivername.startswith("sqlite"):
+            @event.listens_for(db.engine, "connect")
+            def _set_sqlite_pragma(dbapi_conn, _):
+                cur = dbapi_conn.cursor()
+                cur.execute("PRAGMA journal_mode=WAL")
+                cur.execute("PRAGMA synchronous=NORMAL")
+                cur.execute("PRAGMA temp_store=MEMORY")
+                cur.execute("PRAGMA mmap_size=268435456")
+                cur.execute("PRAGMA cache_size=-65536")
+                cur.close()
+
     login_manager = LoginManager(app)
     login_manager.login_view = "login"
 
@@ -46,24 +136,32 @@ def create_app():
 
     socketio = SocketIO(app,
                         cors_allowed_origins=app.config.get("SOCKETIO_CORS_ALLOWED_ORIGINS"),
-                        async_mode="threading",
+                        async_mode="gevent",
+                        json=OrjsonSocketIOJSON,
                         manage_session=True,
-                        logger=True,
-                        engineio_logger=True)
+                        logger=app.debug,
+                        engineio_logger=app.debug)
     
     # Add global exception handler for Socket.IO
     @socketio.on_error_default
     def default_error_handler(e):
-        print(f"❌ Socket.IO error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Socket.IO error")
         return False
 
+    # Health check endpoint for Render, answered before Socket.IO, sessions and
+    # Flask-Login run (the probe hits it every few seconds)
+    flask_wsgi_app = app.wsgi_app
+
+    def healthz_wsgi_app(environ, start_response):
+        if environ.get("PATH_INFO") == "/healthz":
+            start_response("200 OK", [("Content-Type", "application/json"),
+                                      ("Content-Length", str(len(HEALTHZ_BODY)))])
+            return [HEALTHZ_BODY]
+        return flask_wsgi_app(environ, start_response)
+
+    app.wsgi_app = healthz_wsgi_app
+
     # ---------------- ROUTES ----------------
-    # Health check endpoint for Render
-    @app.route("/healthz")
-    def healthz():
-        return jsonify({"status": "healthy"}), 200
 
     @app.route("/")
     def index():
@@ -92,10 +190,12 @@ def create_app():
                 
                 user = User.query.filter_by(username=username).first()
 
-                if user and check_password_hash(user.password_hash, password):
+                if user is None:
+                    # Always pay for one hash check: no timing oracle for valid usernames
+                    verify_password(_DUMMY_HASH, password)
+                elif verify_password(user.password_hash, password):
                     login_user(user, remember=True)
-                    user.status = "online"
-                    db.session.commit()
+                    queue_status(user.id, "online")
                     return redirect(url_for("messenger"))
 
                 flash("Invalid username or password.", "error")
@@ -131,7 +231,7 @@ def create_app():
                     return render_template("register.html"), 409
 
                 user = User(username=username,
-                            password_hash=generate_password_hash(password))
+                            password_hash=hash_password(password))
                 db.session.add(user)
                 db.session.commit()
                 flash("User registered, log in.", "success")
@@ -146,9 +246,25 @@ def create_app():
     @app.route("/messenger")
     @login_required
     def messenger():
+        # One aggregate row versions the whole sidebar; revalidating browsers get a 304
+        # without the full users scan. updated_at also moves with the viewer's coins.
+        user_count, max_id, max_updated = db.session.execute(
+            select(func.count(User.id), func.max(User.id), func.max(User.updated_at))
+        ).one()
+        etag = hashlib.md5(
+            f"{PAGE_VERSION}:{current_user.id}:{user_count}:{max_id}:{max_updated}".encode()).hexdigest()
+        # Pending flash messages are part of the page, so always render those
+        if "_flashes" not in session and request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+
         users = User.query.filter(User.id != current_user.id).all()
         rooms = VoiceRoom.query.filter_by(active=True).all()
-        return render_template("messenger.html", users=users, me=current_user, rooms=rooms)
+        response = make_response(render_template("messenger.html", users=users, me=current_user, rooms=rooms))
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
 
     @app.route("/voice-rooms")
     @login_required
@@ -163,20 +279,28 @@ def create_app():
         name = (data.get("name") or "Room").strip() or "Room"
         room = VoiceRoom(name=name, created_by=current_user.id)
         db.session.add(room)
-        db.session.commit()
+        # flush assigns room.id so room + host row share a single commit
+        db.session.flush()
         vp = VoiceParticipant(room_id=room.id,
                               user_id=current_user.id,
                               role="host")
         db.session.add(vp)
         db.session.commit()
+        invalidate_host_cache(room.id)
         return jsonify({"id": room.id, "name": room.name})
 
     @app.route("/api/messages")
     @login_required
     def api_messages():
-        """Get messages for lobby or private chat"""
+        """Get the most recent messages for lobby or private chat, oldest first.
+
+        Page back with ?before=<created_at of the oldest message>&before_id=<its id>.
+        """
         room = request.args.get("room")
         recipient_id = request.args.get("recipient_id", type=int)
+        limit = min(max(request.args.get("limit", MESSAGES_PAGE_SIZE, type=int), 1), 100)
+        before = request.args.get("before")
+        before_id = request.args.get("before_id", type=int)
         
         query = Message.query
         if room:
@@ -189,11 +313,28 @@ def create_app():
             )
         else:
             return jsonify({"error": "room or recipient_id required"}), 400
-        
-        messages = query.order_by(Message.created_at.asc()).limit(100).all()
+
+        if before:
+            try:
+                before = datetime.fromisoformat(before)
+            except ValueError:
+                return jsonify({"error": "before must be an ISO timestamp"}), 400
+            # Keyset cursor: (created_at, id) breaks ties between same-timestamp messages
+            if before_id:
+                query = query.filter((Message.created_at < before) |
+                                     ((Message.created_at == before) & (Message.id < before_id)))
+            else:
+                query = query.filter(Message.created_at < before)
+
+        # Newest page first so the index is read from the tail, then flip for display.
+        # Senders load in one extra SELECT instead of one query per message.
+        messages = (query.options(selectinload(Message.sender), raiseload("*"))
+                    .order_by(Message.created_at.desc(), Message.id.desc())
+                    .limit(limit)
+                    .all())
         result = []
-        for msg in messages:
-            sender = User.query.get(msg.sender_id)
+        for msg in reversed(messages):
+            sender = msg.sender
             result.append({
                 "id": msg.id,
                 "body": msg.body,
@@ -201,41 +342,104 @@ def create_app():
                 "sender_username": sender.username if sender else "Unknown",
                 "recipient_id": msg.recipient_id,
                 "room": msg.room,
-                "created_at": msg.created_at.isoformat()
+                "created_at": msg.created_at
             })
         return jsonify(result)
 
     @app.route("/logout")
     @login_required
     def logout():
-        try:
-            current_user.status = "offline"
-            db.session.commit()
-        except Exception as e:
-            db.session.rollback()
+        queue_status(current_user.id, "offline")
         logout_user()
         return redirect(url_for("login"))
 
     # ---------------- HELPERS ----------------
     def dm_allowed(sender_id, recipient_id):
         """Return True if sender can DM recipient without coins (<=3 msgs since last reply)."""
-        unlock = DMUnlock.query.filter_by(user_id=sender_id,
-                                          target_id=recipient_id).first()
-        if unlock and (not unlock.expires_at or unlock.expires_at > datetime.utcnow()):
+        # Unlock check, last reply and unanswered count in a single roundtrip
+        unlocked = (select(DMUnlock.id)
+                    .where(DMUnlock.user_id == sender_id,
+                           DMUnlock.target_id == recipient_id,
+                           or_(DMUnlock.expires_at.is_(None),
+                               DMUnlock.expires_at > datetime.utcnow()))
+                    .exists())
+
+        reply = aliased(Message)
+        last_reply = (select(func.max(reply.created_at))
+                      .where(reply.sender_id == recipient_id,
+                             reply.recipient_id == sender_id)
+                      .scalar_subquery())
+
+        # Only "fewer than the limit?" matters, so stop reading after DM_FREE_MSG_LIMIT rows
+        recent = (select(Message.id)
+                  .where(Message.sender_id == sender_id,
+                         Message.recipient_id == recipient_id,
+                         Message.created_at > func.coalesce(last_reply, datetime.min))
+                  .limit(DM_FREE_MSG_LIMIT)
+                  .subquery())
+        sent_since = select(func.count()).select_from(recent).scalar_subquery()
+
+        is_unlocked, count = db.session.execute(select(unlocked, sent_since)).one()
+        if is_unlocked:
             return True
+        return count < DM_FREE_MSG_LIMIT
 
-        last_reply = (Message.query
-                      .filter_by(sender_id=recipient_id, recipient_id=sender_id)
-                      .order_by(Message.created_at.desc())
-                      .first())
-        since = last_reply.created_at if last_reply else datetime.min
+    def get_host_ids(room_id):
+        """Return host user ids for a voice room, cached for HOST_CACHE_TTL seconds."""
+        with _host_cache_lock:
+            host_ids = _host_cache.get(room_id)
+        if host_ids is not None:
+            return host_ids
+
+        host_ids = [uid for (uid,) in
+                    VoiceParticipant.query.filter_by(room_id=room_id, role="host")
+                    .with_entities(VoiceParticipant.user_id).all()]
+        with _host_cache_lock:
+            _host_cache[room_id] = host_ids
+        return host_ids
+
+    def voice_room_id(data):
+        """room_id from a client payload as an int (one cache key per room), or None."""
+        try:
+            return int(data.get("room_id"))
+        except (TypeError, ValueError):
+            return None
+
+    def invalidate_host_cache(room_id):
+        with _host_cache_lock:
+            _host_cache.pop(room_id, None)
+
+    def queue_status(user_id, status):
+        """Record a presence change; flush_status_updates writes it within STATUS_FLUSH_INTERVAL."""
+        with _pending_status_lock:
+            _pending_status[user_id] = status
+
+    def flush_status_updates():
+        """Background loop: one UPDATE per status value instead of a commit per (dis)connect."""
+        while True:
+            socketio.sleep(STATUS_FLUSH_INTERVAL)
+            with _pending_status_lock:
+                pending = dict(_pending_status)
+                _pending_status.clear()
+            if not pending:
+                continue
+
+            by_status = {}
+            for user_id, status in pending.items():
+                by_status.setdefault(status, []).append(user_id)
+            with app.app_context():
+                try:
+                    for status, user_ids in by_status.items():
+                        db.session.execute(update(User)
+                                           .where(User.id.in_(user_ids))
+                                           .values(status=status)
+                                           .execution_options(synchronize_session=False))
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    logger.exception("Error flushing status updates")
 
-        count = (Message.query
-                 .filter(Message.sender_id == sender_id,
-                         Message.recipient_id == recipient_id,
-                         Message.created_at > since)
-                 .count())
-        return count < DM_FREE_MSG_LIMIT
+    socketio.start_background_task(flush_status_updates)
 
     # ---------------- SOCKET.IO ----------------
     def authenticated_only(f):
@@ -252,38 +456,33 @@ def create_app():
     def sio_connect(auth):
         """Handle Socket.IO connection with proper authentication"""
         try:
-            # Debug: Print session contents
-            print(f"Connect attempt - Session keys: {list(session.keys())}")
-            print(f"Connect attempt - current_user: {current_user}")
-            print(f"Connect attempt - current_user.is_authenticated: {getattr(current_user, 'is_authenticated', False)}")
-            
             user_id = None
             
             # Try multiple ways to get user ID
             # Flask-Login uses '_user_id' by default, but check all possibilities
             if hasattr(current_user, 'is_authenticated') and current_user.is_authenticated:
                 user_id = current_user.id
-                print(f"Got user_id from current_user: {user_id}")
             elif '_user_id' in session:
                 user_id = session['_user_id']
-                print(f"Got user_id from session['_user_id']: {user_id}")
             elif 'user_id' in session:
                 user_id = session['user_id']
-                print(f"Got user_id from session['user_id']: {user_id}")
             elif '_id' in session:
                 user_id = session['_id']
-                print(f"Got user_id from session['_id']: {user_id}")
             
             if user_id:
                 try:
                     user_id = int(user_id)
                 except (ValueError, TypeError):
-                    print(f"Invalid user_id: {user_id}")
+                    logger.warning("Invalid user_id in session: %r", user_id)
                     # Allow connection anyway, auth will be checked in handlers
                     join_room("lobby")
                     return True
                 
-                user = User.query.get(user_id)
+                # current_user was already loaded by the user_loader; only look up session-only ids
+                if current_user.is_authenticated and current_user.id == user_id:
+                    user = current_user
+                else:
+                    user = User.query.get(user_id)
                 if user:
                     # Ensure user is logged in for this context
                     if not hasattr(current_user, 'is_authenticated') or not current_user.is_authenticated:
@@ -291,31 +490,23 @@ def create_app():
                     
                     join_room(str(user_id))
                     join_room("lobby")
-                    try:
-                        user.status = "online"
-                        db.session.commit()
-                    except Exception as e:
-                        db.session.rollback()
-                        print(f"Error updating user status: {e}")
-                    
+                    queue_status(user_id, "online")
                     emit("status", {"user_id": user_id, "status": "online"},
                          broadcast=True)
-                    print(f"✅ User {user_id} ({user.username}) connected to Socket.IO")
+                    logger.info("User %s (%s) connected to Socket.IO", user_id, user.username)
                     return True
                 else:
-                    print(f"⚠️ User {user_id} not found in database - allowing connection")
+                    logger.warning("User %s not found in database - allowing connection", user_id)
                     # Allow connection, will check auth in message handlers
                     join_room("lobby")
                     return True
             else:
-                print("⚠️ No authenticated user found - allowing connection (auth checked in handlers)")
+                logger.debug("No authenticated user found - allowing connection (auth checked in handlers)")
                 # Allow connection even without auth - will check in message handlers
                 join_room("lobby")
                 return True
-        except Exception as e:
-            print(f"❌ Error in connect handler: {e}")
-            import traceback
-            traceback.print_exc()
+        except Exception:
+            logger.exception("Error in connect handler")
             # Allow connection for debugging
             return True
 
@@ -332,20 +523,11 @@ def create_app():
                     pass
             
             if user_id:
-                try:
-                    user = User.query.get(user_id)
-                    if user:
-                        user.status = "offline"
-                        db.session.commit()
-                        emit("status", {"user_id": user_id, "status": "offline"},
-                             broadcast=True)
-                except Exception as e:
-                    db.session.rollback()
-                    print(f"Error in disconnect handler: {e}")
-        except Exception as e:
-            print(f"Error in disconnect handler: {e}")
-            import traceback
-            traceback.print_exc()
+                queue_status(user_id, "offline")
+                emit("status", {"user_id": user_id, "status": "offline"},
+                     broadcast=True)
+        except Exception:
+            logger.exception("Error in disconnect handler")
 
     @socketio.on("join_room")
     def sio_join_room(data):
@@ -353,10 +535,8 @@ def create_app():
             room = data.get("room") if data else None
             if room:
                 join_room(room)
-        except Exception as e:
-            print(f"Error in join_room handler: {e}")
-            import traceback
-            traceback.print_exc()
+        except Exception:
+            logger.exception("Error in join_room handler")
 
     @socketio.on("send_message")
     def sio_send_message(data):
@@ -378,7 +558,7 @@ def create_app():
                     sender_id = None
             
             if not sender_id:
-                print("❌ No sender_id found in send_message")
+                logger.warning("No sender_id found in send_message")
                 emit("blocked_message", {"reason": "Not authenticated."}, room=request.sid)
                 return
             
@@ -389,7 +569,7 @@ def create_app():
             if not body:
                 return
 
-            print(f"📨 Message from user {sender_id}: {body[:50]}... (room={room}, recipient={recipient_id})")
+            logger.debug("Message from user %s (room=%s, recipient=%s)", sender_id, room, recipient_id)
 
             # DM gate
             if recipient_id and not dm_allowed(sender_id, recipient_id):
@@ -398,44 +578,44 @@ def create_app():
                      room=str(sender_id))
                 return
 
+            # Read the sender name while current_user is still loaded: the commit
+            # below expires it, and touching it afterwards would re-SELECT the row
+            if current_user.is_authenticated and current_user.id == sender_id:
+                sender_username = current_user.username
+            else:
+                sender = User.query.get(sender_id)
+                sender_username = sender.username if sender else None
+
             msg = Message(body=body,
                           sender_id=sender_id,
                           recipient_id=recipient_id,
                           room=room)
             db.session.add(msg)
-            db.session.commit()
-
-            sender = User.query.get(sender_id)
+            # flush assigns id/created_at; build the payload before commit expires msg
+            db.session.flush()
             payload = {
                 "id": msg.id,
                 "body": msg.body,
                 "sender_id": msg.sender_id,
-                "sender_username": sender.username if sender else "Unknown",
+                "sender_username": sender_username or "Unknown",
                 "recipient_id": msg.recipient_id,
                 "room": msg.room,
-                "created_at": msg.created_at.isoformat()
+                "created_at": msg.created_at
             }
-
-            print(f"📤 Emitting message: {payload}")
+            db.session.commit()
 
             if room:
                 # Lobby message - send to all in lobby room
                 emit("new_message", payload, to=room)
-                print(f"✅ Sent to room: {room}")
             elif recipient_id:
-                # Private message - send to both users
-                emit("new_message", payload, room=str(recipient_id))
-                emit("new_message", payload, room=str(sender_id))
-                print(f"✅ Sent to users: {recipient_id} and {sender_id}")
+                # Private message - one emit to both users' rooms, encoded once
+                emit("new_message", payload, to=[str(recipient_id), str(sender_id)])
             else:
                 # Default to lobby
                 emit("new_message", payload, to="lobby")
-                print(f"✅ Sent to lobby")
-        except Exception as e:
+        except Exception:
             db.session.rollback()
-            print(f"❌ Error sending message: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Error sending message")
             emit("blocked_message", {"reason": "Error sending message."}, room=request.sid)
 
     @socketio.on("send_coins")
@@ -447,46 +627,63 @@ def create_app():
         if amount <= 0:
             return
 
+        # Read once up front: the commit expires current_user, and touching it
+        # afterwards would re-SELECT the row just for its id
+        sender_id = current_user.id
+
         try:
-            if current_user.coins < amount:
+            # Conditional debit: the balance check and the write are one statement,
+            # so concurrent gifts can't overdraw the sender
+            sender_coins = db.session.execute(
+                update(User)
+                .where(User.id == sender_id, User.coins >= amount)
+                .values(coins=User.coins - amount)
+                .returning(User.coins)
+                .execution_options(synchronize_session=False)
+            ).scalar_one_or_none()
+            if sender_coins is None:
                 emit("blocked_message", {"reason": "Not enough coins."},
-                     room=str(current_user.id))
+                     room=str(sender_id))
                 return
 
-            recipient = User.query.get(to_id)
-            if not recipient:
+            recipient_coins = db.session.execute(
+                update(User)
+                .where(User.id == to_id)
+                .values(coins=User.coins + amount)
+                .returning(User.coins)
+                .execution_options(synchronize_session=False)
+            ).scalar_one_or_none()
+            if recipient_coins is None:
+                db.session.rollback()
                 emit("blocked_message", {"reason": "User not found."},
-                     room=str(current_user.id))
+                     room=str(sender_id))
                 return
 
-            current_user.coins -= amount
-            recipient.coins += amount
-            tx = CoinTransaction(from_id=current_user.id,
-                                 to_id=recipient.id,
+            tx = CoinTransaction(from_id=sender_id,
+                                 to_id=to_id,
                                  amount=amount,
                                  note="gift")
             db.session.add(tx)
 
-            unlock = DMUnlock.query.filter_by(user_id=current_user.id,
-                                              target_id=recipient.id).first()
-            if not unlock:
-                unlock = DMUnlock(user_id=current_user.id,
-                                  target_id=recipient.id,
-                                  expires_at=datetime.utcnow() + timedelta(days=30))
-                db.session.add(unlock)
-            else:
-                unlock.expires_at = datetime.utcnow() + timedelta(days=30)
+            expiry = datetime.utcnow() + timedelta(days=30)
+            insert = pg_insert if db.engine.dialect.name == "postgresql" else sqlite_insert
+            stmt = insert(DMUnlock).values(user_id=sender_id,
+                                           target_id=to_id,
+                                           expires_at=expiry)
+            stmt = stmt.on_conflict_do_update(index_elements=["user_id", "target_id"],
+                                              set_={"expires_at": expiry})
+            db.session.execute(stmt)
 
             db.session.commit()
             emit("coins_update",
-                 {"user_id": current_user.id, "coins": current_user.coins},
-                 room=str(current_user.id))
+                 {"user_id": sender_id, "coins": sender_coins},
+                 room=str(sender_id))
             emit("coins_update",
-                 {"user_id": recipient.id, "coins": recipient.coins},
-                 room=str(recipient.id))
+                 {"user_id": to_id, "coins": recipient_coins},
+                 room=str(to_id))
         except Exception as e:
             db.session.rollback()
-            emit("blocked_message", {"reason": "Error sending coins."}, room=str(current_user.id))
+            emit("blocked_message", {"reason": "Error sending coins."}, room=str(sender_id))
 
     # Lobby voice invite (optional quick group call hook)
     @socketio.on("lobby_voice_invite")
@@ -499,7 +696,9 @@ def create_app():
     @socketio.on("voice_join")
     @authenticated_only
     def sio_voice_join(data):
-        room_id = data.get("room_id")
+        room_id = voice_room_id(data)
+        if room_id is None:
+            return
         room_name = f"voice_{room_id}"
         join_room(room_name)
 
@@ -512,6 +711,7 @@ def create_app():
                                       role="listener")
                 db.session.add(vp)
                 db.session.commit()
+                invalidate_host_cache(room_id)
 
             emit("voice_user_joined",
                  {"user_id": current_user.id, "role": vp.role},
@@ -523,14 +723,17 @@ def create_app():
     @socketio.on("voice_leave")
     @authenticated_only
     def sio_voice_leave(data):
-        room_id = data.get("room_id")
+        room_id = voice_room_id(data)
+        if room_id is None:
+            return
         room_name = f"voice_{room_id}"
         leave_room(room_name)
 
         try:
             VoiceParticipant.query.filter_by(room_id=room_id,
-                                             user_id=current_user.id).delete()
+                                             user_id=current_user.id).delete(synchronize_session=False)
             db.session.commit()
+            invalidate_host_cache(room_id)
             emit("voice_user_left", {"user_id": current_user.id}, to=room_name)
         except Exception as e:
             db.session.rollback()
@@ -538,10 +741,10 @@ def create_app():
     @socketio.on("voice_request_stage")
     @authenticated_only
     def sio_voice_request_stage(data):
-        room_id = data.get("room_id")
-        host_ids = [p.user_id for p in
-                    VoiceParticipant.query.filter_by(room_id=room_id, role="host").all()]
-        for hid in host_ids:
+        room_id = voice_room_id(data)
+        if room_id is None:
+            return
+        for hid in get_host_ids(room_id):
             emit("voice_stage_request",
                  {"from": current_user.id, "room_id": room_id},
                  room=str(hid))
@@ -638,6 +841,10 @@ if __name__ == "__main__":
             print(f"Database path: {app.config['SQLALCHEMY_DATABASE_URI']}")
             print(f"Instance path: {instance_path}")
             raise
+        # Schema catch-up for older databases; both log their own per-item failures
+        add_missing_columns()
+        collapse_duplicate_dm_unlocks()
+        create_missing_indexes()
     
     # Use environment variable for debug mode (set to False in production)
     debug_mode = os.environ.get("FLASK_DEBUG", "False").lower() == "true"
@@ -1,4 +1,6 @@
 import os
+from sqlalchemy.pool import StaticPool
+
 BASEDIR = os.path.abspath(os.path.dirname(__file__))
 
 class Config:
@@ -20,6 +22,22 @@ class Config:
     default_db_uri = f"sqlite:///{_db_path}"
     SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL") or default_db_uri
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_RECORD_QUERIES = False
+    # Pool server-side DB connections (Postgres etc.) so greenlets reuse them and
+    # stale ones are caught by pre-ping; SQLite keeps SQLAlchemy's default pool
+    if not SQLALCHEMY_DATABASE_URI.startswith("sqlite"):
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            "pool_size": 10,
+            "max_overflow": 20,
+            "pool_pre_ping": True,
+            "pool_recycle": 1800,
+        }
+    elif SQLALCHEMY_DATABASE_URI in ("sqlite://", "sqlite:///:memory:"):
+        # One shared in-memory database across threads/greenlets
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            "poolclass": StaticPool,
+            "connect_args": {"check_same_thread": False},
+        }
     # In production, set this to your actual domain(s)
     # Handle CORS_ORIGINS: "*" means allow all, otherwise split by comma
     cors_origins_env = os.environ.get("CORS_ORIGINS", "*")
@@ -27,4 +45,5 @@ class Config:
         SOCKETIO_CORS_ALLOWED_ORIGINS = "*"  # Allow all origins
     else:
         SOCKETIO_CORS_ALLOWED_ORIGINS = [origin.strip() for origin in cors_origins_env.split(",")]
-    TEMPLATES_AUTO_RELOAD = True
+    # Re-stat templates on every render only while developing
+    TEMPLATES_AUTO_RELOAD = os.environ.get("FLASK_DEBUG", "False").lower() == "true"
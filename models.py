@@ -1,8 +1,10 @@
 from datetime import datetime
+import logging
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 
 db = SQLAlchemy()
+logger = logging.getLogger(__name__)
 
 class User(db.Model, UserMixin):
     __tablename__ = "users"
@@ -12,9 +14,17 @@ class User(db.Model, UserMixin):
     status = db.Column(db.String(20), default="offline")
     is_admin = db.Column(db.Boolean, default=False)
     coins = db.Column(db.Integer, default=1000)
+    # bumped on any row change (status, coins); feeds the /messenger ETag
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 class Message(db.Model):
     __tablename__ = "messages"
+    __table_args__ = (
+        # DM gate / history lookups filter on both ends of the conversation
+        db.Index("ix_msg_sr_time", "sender_id", "recipient_id", "created_at"),
+        db.Index("ix_msg_rs_time", "recipient_id", "sender_id", "created_at"),
+        db.Index("ix_msg_room_time", "room", "created_at"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -22,6 +32,8 @@ class Message(db.Model):
     recipient_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     room = db.Column(db.String(120))
 
+    sender = db.relationship("User", foreign_keys=[sender_id], lazy="raise")
+
 class CoinTransaction(db.Model):
     __tablename__ = "coin_transactions"
     id = db.Column(db.Integer, primary_key=True)
@@ -33,6 +45,10 @@ class CoinTransaction(db.Model):
 
 class DMUnlock(db.Model):
     __tablename__ = "dm_unlocks"
+    __table_args__ = (
+        # unique so gifts can upsert the unlock with INSERT ... ON CONFLICT
+        db.Index("uq_dm_unlock", "user_id", "target_id", unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
     target_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
@@ -61,3 +77,57 @@ class VoiceComment(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
     body = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+def add_missing_columns():
+    """ALTER existing tables to add nullable columns declared after they were created.
+
+    Each column is added on its own; a failure is logged and the rest still run.
+    """
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {col["name"] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            col_type = column.type.compile(dialect=db.engine.dialect)
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(db.text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}"))
+            except Exception:
+                logger.exception("Could not add column %s.%s", table.name, column.name)
+
+def collapse_duplicate_dm_unlocks():
+    """Keep one dm_unlocks row per (user_id, target_id) so uq_dm_unlock can be built.
+
+    Older databases could gain duplicates from the old check-then-insert gift path.
+    The survivor is the row that unlocks longest: no expiry first, then latest expires_at.
+    """
+    if not db.inspect(db.engine).has_table(DMUnlock.__tablename__):
+        return
+    with db.engine.begin() as conn:
+        result = conn.execute(db.text("""
+            DELETE FROM dm_unlocks WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (
+                        PARTITION BY user_id, target_id
+                        ORDER BY CASE WHEN expires_at IS NULL THEN 0 ELSE 1 END,
+                                 expires_at DESC, id DESC) AS rn
+                    FROM dm_unlocks
+                ) ranked WHERE rn > 1)
+        """))
+    if result.rowcount:
+        logger.warning("Removed %s duplicate dm_unlocks rows", result.rowcount)
+
+def create_missing_indexes():
+    """Add indexes declared above to tables that predate them (create_all skips existing tables).
+
+    Each index is created on its own; a failure is logged and the rest still run.
+    """
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(db.engine, checkfirst=True)
+            except Exception:
+                logger.exception("Could not create index %s on %s", index.name, table.name)
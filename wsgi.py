@@ -1,18 +1,21 @@
 import os
 from app import create_app
-import eventlet
 
 # Create app instance
 app, socketio = create_app()
 
 # Initialize database tables
 with app.app_context():
-    from models import db
+    from models import db, add_missing_columns, collapse_duplicate_dm_unlocks, create_missing_indexes
     try:
         db.create_all()
         print("✅ Database initialized")
     except Exception as e:
         print(f"⚠️ Database initialization warning: {e}")
+    # Schema catch-up for older databases; both log their own per-item failures
+    add_missing_columns()
+    collapse_duplicate_dm_unlocks()
+    create_missing_indexes()
 
 # Export for gunicorn
 application = app